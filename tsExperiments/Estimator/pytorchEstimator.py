@@ -25,7 +25,10 @@ from gluonts.transform import SelectFields, Transformation
 from gluonts.itertools import maybe_len
 
 from .Trainer import Trainer
-from tsExperiments.data_and_transformation import TransformedIterableDataset
+from tsExperiments.data_and_transformation import (
+    TransformedIterableDataset,
+    seed_worker,
+)
 
 
 def get_module_forward_input_names(module: nn.Module):
@@ -135,7 +138,7 @@ class PyTorchEstimator(Estimator):
             num_workers=num_workers,
             prefetch_factor=prefetch_factor,
             pin_memory=True,
-            worker_init_fn=self._worker_init_fn,
+            worker_init_fn=seed_worker,
             **kwargs,
         )
 
@@ -159,7 +162,7 @@ class PyTorchEstimator(Estimator):
                 num_workers=num_workers,
                 prefetch_factor=prefetch_factor,
                 pin_memory=True,
-                worker_init_fn=self._worker_init_fn,
+                worker_init_fn=seed_worker,
                 **kwargs,
             )
 
@@ -177,10 +180,6 @@ class PyTorchEstimator(Estimator):
             ),
         )
 
-    @staticmethod
-    def _worker_init_fn(worker_id):
-        np.random.seed(np.random.get_state()[1][0] + worker_id)
-
     def train(
         self,
         training_data: Dataset,
@@ -1,12 +1,16 @@
 """The original class for Estimation from GluonTS."""
 # See https://ts.gluon.ai/stable/_modules/gluonts/torch/model/estimator.html#PyTorchLightningEstimator
 
-from typing import NamedTuple, Optional, Iterable, Dict, Any
+from typing import Optional, Iterable, Dict, Any, Literal, Tuple
+from dataclasses import dataclass
+import copy
 import logging
+import weakref
 
-import numpy as np
 import lightning.pytorch as pl
+import torch
 import torch.nn as nn
+from lightning_utilities.core.apply_func import apply_to_collection
 
 from gluonts.core.component import validated
 from gluonts.dataset.common import Dataset
@@ -16,10 +20,105 @@ from gluonts.model import Estimator, Predictor
 from gluonts.torch.model.predictor import PyTorchPredictor
 from gluonts.transform import Transformation
 
+from tsExperiments.data_and_transformation import MmapCachedDataset
+
 logger = logging.getLogger(__name__)
 
 
-class TrainOutput(NamedTuple):
+_dataset_lengths: Dict[int, Tuple[weakref.ref, Optional[int]]] = {}
+
+
+def _dataset_len(data: Dataset) -> Optional[int]:
+    """
+    Length of `data` (None if it has no `__len__`), memoized per dataset
+    object: for file datasets, `len` reads through all the records.
+    """
+    key = id(data)
+    cached = _dataset_lengths.get(key)
+    if cached is not None and cached[0]() is data:
+        return cached[1]
+
+    length = len(data) if hasattr(data, "__len__") else None
+    try:
+        ref = weakref.ref(data, lambda _: _dataset_lengths.pop(key, None))
+    except TypeError:  # not weak referenceable, e.g. lists, cheap to measure
+        return length
+    _dataset_lengths[key] = (ref, length)
+    return length
+
+
+def _nbytes(batch) -> int:
+    sizes = []
+    apply_to_collection(batch, torch.Tensor, lambda t: sizes.append(t.nbytes))
+    return sum(sizes)
+
+
+class _PinnedBatches:
+    """
+    Wraps an iterable over batches and pins their tensors in page-locked host
+    memory, so that Lightning's `non_blocking` host-to-device copies go
+    through DMA instead of a synchronous pageable-memory staging copy.
+    """
+
+    def __init__(self, batches: Iterable) -> None:
+        self.batches = batches
+
+    def __iter__(self):
+        for batch in self.batches:
+            yield apply_to_collection(batch, torch.Tensor, torch.Tensor.pin_memory)
+
+    def __len__(self) -> int:
+        return len(self.batches)
+
+
+class _PreloadedBatches:
+    """
+    Records the batches of a first complete pass over `batches` and replays
+    them on later iterations, so that the transformation and batching only
+    run once. Recording is given up for good (and batches are drawn anew on
+    every pass) once the recorded tensors would exceed `max_bytes`.
+    """
+
+    def __init__(self, batches: Iterable, max_bytes: int) -> None:
+        self.batches = batches
+        self.max_bytes = max_bytes
+        self._recorded: Optional[list] = None
+        self._recording = True
+
+    def __iter__(self):
+        if self._recorded is not None:
+            yield from self._recorded
+            return
+        if not self._recording:
+            yield from self.batches
+            return
+
+        recorded = []
+        num_bytes = 0
+        for batch in self.batches:
+            if recorded is not None:
+                num_bytes += _nbytes(batch)
+                if num_bytes > self.max_bytes:
+                    recorded = None
+                    self._recording = False
+                else:
+                    recorded.append(batch)
+            yield batch
+        # interrupted passes (e.g. sanity checks) are not kept
+        if recorded is not None:
+            self._recorded = recorded
+
+    def clear(self) -> None:
+        self._recorded = None
+
+    def __len__(self) -> int:
+        if self._recorded is not None:
+            return len(self._recorded)
+        return len(self.batches)
+
+
+@dataclass(slots=True, frozen=True)
+class TrainOutput:
     transformation: Transformation
     trained_net: nn.Module
     trainer: pl.Trainer
@@ -34,6 +133,27 @@ class PyTorchLightningEstimator(Estimator):
     To extend this class, one needs to implement three methods:
     `create_transformation`, `create_training_network`, `create_predictor`,
     `create_training_data_loader`, and `create_validation_data_loader`.
+
+    With `compile_model=True`, the Lightning module is wrapped with
+    `torch.compile` (using `compile_mode`) before fitting; the returned
+    network and predictor always hold the original, uncompiled module.
+
+    Unless `precision` is given in `trainer_kwargs`, training on GPU uses
+    mixed precision ("bf16-mixed", or "16-mixed" on GPUs without bfloat16
+    support). Lightning autocasts the training step, so modules computing
+    their loss in a custom dtype must cast it back explicitly.
+
+    `trainer_kwargs` may also hold a `target_effective_batch_size` (and a
+    `device_batch_size`, defaulting to the estimator's `batch_size`), from
+    which `accumulate_grad_batches` is derived given the number of devices
+    and nodes, unless it is set explicitly.
+
+    With a `preload_validation_max_bytes` budget in `trainer_kwargs`, the
+    batches of the first validation pass are recorded (unpinned, as long as
+    they fit the budget) and replayed by the following ones until
+    `train_model` returns. This freezes the validation windows: the first
+    draw of the validation instance sampler is then scored at every epoch,
+    instead of new random windows.
     """
 
     @validated()
@@ -41,9 +161,14 @@ class PyTorchLightningEstimator(Estimator):
         self,
         trainer_kwargs: Dict[str, Any],
         lead_time: int = 0,
+        compile_model: bool = False,
+        compile_mode: str = "reduce-overhead",
     ) -> None:
         super().__init__(lead_time=lead_time)
         self.trainer_kwargs = trainer_kwargs
+        self.compile_model = compile_model
+        self.compile_mode = compile_mode
+        self._cached_transformation: Optional[Transformation] = None
 
     def create_transformation(self) -> Transformation:
         """
@@ -57,6 +182,13 @@ class PyTorchLightningEstimator(Estimator):
         """
         raise NotImplementedError
 
+    def invalidate_transformation(self) -> None:
+        """
+        Drop the transformation memoized by `train_model`, so that the next
+        call rebuilds it (e.g. after changing hyperparameters it depends on).
+        """
+        self._cached_transformation = None
+
     def create_lightning_module(self) -> pl.LightningModule:
         """
         Create and return the network used for training (i.e., computing the
@@ -139,16 +271,30 @@ class PyTorchLightningEstimator(Estimator):
         shuffle_buffer_length: Optional[int] = None,
         cache_data: bool = False,
         ckpt_path: Optional[str] = None,
+        cache_backend: Literal["ram", "mmap"] = "ram",
         **kwargs,
     ) -> TrainOutput:
-        transformation = self.create_transformation()
+        # work on a copy, so that repeated calls (e.g. in sweeps) see the same
+        # options
+        trainer_kwargs = dict(self.trainer_kwargs)
+        accelerator = trainer_kwargs.get("accelerator", "auto")
+
+        if self._cached_transformation is None:
+            self._cached_transformation = self.create_transformation()
+        transformation = self._cached_transformation
 
-        with env._let(max_idle_transforms=max(len(training_data), 100)):
+        # page-locked memory only helps copies to GPUs
+        pin_memory = self._uses_cuda(accelerator)
+
+        n_train = _dataset_len(training_data) or 0
+        with env._let(max_idle_transforms=max(n_train, 100)):
             transformed_training_data: Dataset = transformation.apply(
                 training_data, is_train=True
             )
             if cache_data:
-                transformed_training_data = Cached(transformed_training_data)
+                transformed_training_data = self._cache(
+                    transformed_training_data, cache_backend
+                )
 
             training_network = self.create_lightning_module()
 
@@ -157,30 +303,61 @@ class PyTorchLightningEstimator(Estimator):
                 training_network,
                 shuffle_buffer_length=shuffle_buffer_length,
             )
+            if pin_memory:
+                training_data_loader = self._pin_batches(training_data_loader)
 
         validation_data_loader = None
+        preloaded_validation = None
+        preload_validation_max_bytes = trainer_kwargs.pop(
+            "preload_validation_max_bytes", 0
+        )
 
         if validation_data is not None:
-            with env._let(max_idle_transforms=max(len(validation_data), 100)):
+            n_val = _dataset_len(validation_data) or 0
+            with env._let(max_idle_transforms=max(n_val, 100)):
                 transformed_validation_data: Dataset = transformation.apply(
                     validation_data, is_train=True
                 )
                 if cache_data:
-                    transformed_validation_data = Cached(transformed_validation_data)
+                    transformed_validation_data = self._cache(
+                        transformed_validation_data, cache_backend
+                    )
 
                 validation_data_loader = self.create_validation_data_loader(
                     transformed_validation_data,
                     training_network,
                 )
+                if preload_validation_max_bytes > 0 and not isinstance(
+                    validation_data_loader, torch.utils.data.DataLoader
+                ):
+                    validation_data_loader = preloaded_validation = (
+                        _PreloadedBatches(
+                            validation_data_loader, preload_validation_max_bytes
+                        )
+                    )
+                # the recorded batches stay in pageable memory, only the
+                # batches being copied to the device are pinned
+                if pin_memory:
+                    validation_data_loader = self._pin_batches(validation_data_loader)
 
         if from_predictor is not None:
             training_network.load_state_dict(from_predictor.network.state_dict())
 
+        if self.compile_model:
+            # let float32 matmuls use TF32 tensor cores, as recommended with Inductor
+            torch.set_float32_matmul_precision("high")
+            # dynamic shapes avoid recompiling for each sequence length
+            training_network = torch.compile(
+                training_network, mode=self.compile_mode, dynamic=True
+            )
+
         monitor = "train_loss" if validation_data is None else "val_loss"
         checkpoint = pl.callbacks.ModelCheckpoint(
             monitor=monitor, mode="min", verbose=True
         )
-        custom_callbacks = self.trainer_kwargs.pop("callbacks", [])
+        # callbacks keep state (best score, patience, best model path): each
+        # call starts from fresh copies of the configured ones
+        custom_callbacks = copy.deepcopy(trainer_kwargs.pop("callbacks", []))
 
         if (
             validation_data is None
@@ -189,18 +366,52 @@ class PyTorchLightningEstimator(Estimator):
         else:  # in this case, we want to save the best model (and optionally the last model), and we use our own callback
             all_callbacks = custom_callbacks
 
-        validation_only = self.trainer_kwargs.pop("validation_only", False)
-        # is_tactis = self.trainer_kwargs.pop("is_tactis", False)
+        validation_only = trainer_kwargs.pop("validation_only", False)
+        # is_tactis = trainer_kwargs.pop("is_tactis", False)
+
+        strategy = trainer_kwargs.pop(
+            "strategy",
+            self._default_strategy(accelerator, trainer_kwargs.get("devices", "auto")),
+        )
+
+        precision = trainer_kwargs.pop(
+            "precision", self._default_precision(accelerator)
+        )
+
+        # accumulating gradients over several steps reaches a given effective
+        # batch size with fewer gradient allreduces under DDP
+        target_effective_batch_size = trainer_kwargs.pop(
+            "target_effective_batch_size", None
+        )
+        device_batch_size = trainer_kwargs.pop(
+            "device_batch_size", getattr(self, "batch_size", None)
+        )
+        derive_accumulation = (
+            target_effective_batch_size is not None
+            and device_batch_size
+            and "accumulate_grad_batches" not in trainer_kwargs
+        )
 
         trainer = pl.Trainer(
             **{
                 "accelerator": "auto",
+                "strategy": strategy,
+                "precision": precision,
                 "callbacks": all_callbacks,
-                "logger": self.trainer_kwargs.pop("logger", None),
-                **self.trainer_kwargs,
+                "logger": trainer_kwargs.pop("logger", None),
+                **trainer_kwargs,
             }
         )
 
+        # the number of processes is only known once Lightning has resolved
+        # the devices, it is read before fitting starts
+        if derive_accumulation:
+            trainer.accumulate_grad_batches = max(
+                1,
+                target_effective_batch_size
+                // (device_batch_size * trainer.world_size),
+            )
+
         if validation_only:
             logger.info("Skipping training and only validating")
             trainer.validate(
@@ -208,7 +419,7 @@ class PyTorchLightningEstimator(Estimator):
                 dataloaders=validation_data_loader,
                 ckpt_path=ckpt_path,
             )
-            best_model = training_network
+            best_model = self._unwrap_compiled(training_network)
         else:
             trainer.fit(
                 model=training_network,
@@ -220,13 +431,21 @@ class PyTorchLightningEstimator(Estimator):
             # if is_tactis:
             #     best_model = training_network
             # else:
-            if checkpoint.best_model_path != "":
+            training_network = self._unwrap_compiled(training_network)
+            if checkpoint.best_model_path == "" or self._has_best_weights(
+                checkpoint, trainer
+            ):
+                best_model = training_network
+            else:
                 logger.info(f"Loading best model from {checkpoint.best_model_path}")
                 best_model = training_network.__class__.load_from_checkpoint(
-                    checkpoint.best_model_path
+                    checkpoint.best_model_path,
+                    map_location=training_network.device,
                 )
-            else:
-                best_model = training_network
+
+        # the trainer returned below still references the validation loader
+        if preloaded_validation is not None:
+            preloaded_validation.clear()
 
         return TrainOutput(
             transformation=transformation,
@@ -236,8 +455,99 @@ class PyTorchLightningEstimator(Estimator):
         )
 
     @staticmethod
-    def _worker_init_fn(worker_id):
-        np.random.seed(np.random.get_state()[1][0] + worker_id)
+    def _has_best_weights(checkpoint, trainer) -> bool:
+        """
+        Whether the module left by `trainer.fit` already holds the weights of
+        the best checkpoint, which then does not need to be read back.
+        """
+        if checkpoint.best_model_path == checkpoint.last_model_path:
+            return True
+        # with a single kept checkpoint, saves only happen on improvement: the
+        # best checkpoint is the final state if it was written at the last step
+        return (
+            checkpoint.save_top_k == 1
+            and getattr(checkpoint, "_last_global_step_saved", -1)
+            == trainer.global_step
+        )
+
+    @staticmethod
+    def _unwrap_compiled(module: nn.Module) -> nn.Module:
+        return getattr(module, "_orig_mod", module)
+
+    @staticmethod
+    def _cache(data: Dataset, cache_backend: str) -> Dataset:
+        # "mmap" keeps the transformed arrays on disk (shared through the page
+        # cache) rather than on the Python heap of every process
+        if cache_backend == "ram":
+            return Cached(data)
+        elif cache_backend == "mmap":
+            return MmapCachedDataset(data)
+        else:
+            raise ValueError(f"Invalid cache backend: {cache_backend}")
+
+    @staticmethod
+    def _pin_batches(data_loader: Iterable) -> Iterable:
+        # torch data loaders pin memory themselves (and must stay visible to
+        # Lightning so that it can inject distributed samplers)
+        if isinstance(data_loader, torch.utils.data.DataLoader):
+            return data_loader
+        return _PinnedBatches(data_loader)
+
+    @staticmethod
+    def _num_devices(devices) -> Optional[int]:
+        """
+        Number of devices set explicitly by `devices`, None when Lightning is
+        left to choose ("auto", -1).
+        """
+        if isinstance(devices, (list, tuple)):
+            return len(devices)
+        elif isinstance(devices, str) and "," in devices:
+            return len([d for d in devices.split(",") if d.strip()])
+        elif devices in ("auto", "-1", -1):
+            return None
+        else:
+            return int(devices)
+
+    @classmethod
+    def _default_strategy(cls, accelerator, devices) -> Any:
+        """
+        Use one process per GPU (DDP over NCCL) when several GPUs are
+        requested explicitly, so that forward passes are not serialized by the
+        GIL as with `DataParallel`. Other runs, including those leaving the
+        devices to Lightning, keep its "auto" strategy.
+        """
+        num_devices = cls._num_devices(devices)
+        if (
+            cls._uses_cuda(accelerator)
+            and torch.cuda.device_count() > 1
+            and num_devices is not None
+            and num_devices > 1
+        ):
+            # the networks use the same parameters at every step, which lets
+            # DDP skip searching the autograd graph for unused ones
+            return pl.strategies.DDPStrategy(
+                process_group_backend="nccl",
+                gradient_as_bucket_view=True,
+                static_graph=True,
+            )
+        return "auto"
+
+    @staticmethod
+    def _uses_cuda(accelerator) -> bool:
+        """
+        Whether `pl.Trainer(accelerator=accelerator)` trains on CUDA GPUs.
+        """
+        if not torch.cuda.is_available():
+            return False
+        if isinstance(accelerator, str):
+            return accelerator in ("auto", "gpu", "cuda")
+        return isinstance(accelerator, pl.accelerators.CUDAAccelerator)
+
+    @classmethod
+    def _default_precision(cls, accelerator) -> str:
+        if not cls._uses_cuda(accelerator):
+            return "32-true"
+        return "bf16-mixed" if torch.cuda.is_bf16_supported() else "16-mixed"
 
     def train(
         self,
@@ -246,6 +556,7 @@ class PyTorchLightningEstimator(Estimator):
         shuffle_buffer_length: Optional[int] = None,
         cache_data: bool = False,
         ckpt_path: Optional[str] = None,
+        cache_backend: Literal["ram", "mmap"] = "ram",
         **kwargs,
     ) -> PyTorchPredictor:
         return self.train_model(
@@ -254,6 +565,7 @@ class PyTorchLightningEstimator(Estimator):
             shuffle_buffer_length=shuffle_buffer_length,
             cache_data=cache_data,
             ckpt_path=ckpt_path,
+            cache_backend=cache_backend,
         ).predictor
 
     def train_from(
@@ -264,6 +576,7 @@ class PyTorchLightningEstimator(Estimator):
         shuffle_buffer_length: Optional[int] = None,
         cache_data: bool = False,
         ckpt_path: Optional[str] = None,
+        cache_backend: Literal["ram", "mmap"] = "ram",
     ) -> PyTorchPredictor:
         assert isinstance(predictor, PyTorchPredictor)
         return self.train_model(
@@ -273,4 +586,5 @@ class PyTorchLightningEstimator(Estimator):
             shuffle_buffer_length=shuffle_buffer_length,
             cache_data=cache_data,
             ckpt_path=ckpt_path,
+            cache_backend=cache_backend,
         ).predictor
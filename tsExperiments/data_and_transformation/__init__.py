@@ -1,4 +1,4 @@
-from .loader import TransformedIterableDataset
+from .loader import TransformedIterableDataset, MmapCachedDataset, seed_worker
 from .scaler import Scaler, MeanScaler, NOPScaler, MeanStdScaler, CenteredMeanScaler
 from .feature import FeatureEmbedder
 from .flows import RealNVP, MAF, FlowOutput
@@ -3,6 +3,14 @@
 
 from typing import Optional
 import itertools
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+import torch
 from torch.utils.data import IterableDataset
 from gluonts.dataset.common import Dataset
 from gluonts.transform import Transformation, TransformedDataset
@@ -11,6 +19,16 @@ from gluonts.itertools import Cyclic, PseudoShuffled, Cached
 # this class is basically doing the same as GluonTS. We authors of pytorch-ts just combined Transformation and creation of iterator in the same function.
 
 
+def seed_worker(worker_id: int) -> None:
+    """
+    Seeds the legacy global NumPy state of a data loader worker, which GluonTS
+    samplers draw from, with its own child of a `np.random.SeedSequence`.
+    """
+    seed_sequence = np.random.SeedSequence(torch.initial_seed() % 2**32)
+    child = seed_sequence.spawn(worker_id + 1)[-1]
+    np.random.seed(child.generate_state(1)[0])
+
+
 class TransformedIterableDataset(IterableDataset):
     def __init__(
         self,
@@ -38,3 +56,89 @@ class TransformedIterableDataset(IterableDataset):
                 shuffle_buffer_length=self.shuffle_buffer_length,
             )
             return iter(shuffled)
+
+
+class MmapCachedDataset:
+    """
+    Disk-backed alternative to `gluonts.itertools.Cached`.
+
+    The first iteration writes every numerical array of each entry to one flat
+    binary file per field; later iterations read them back as (copy-on-write)
+    memory-mapped slices instead of keeping all transformed entries on the
+    Python heap. Non-array fields (start, item_id, ...) are kept in memory.
+    """
+
+    def __init__(self, dataset: Dataset, cache_dir: Optional[str] = None):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        self._entries = None
+        self._arrays = {}
+
+    def __len__(self):
+        if self._entries is not None:
+            return len(self._entries)
+        return len(self.dataset)
+
+    def __iter__(self):
+        if self._entries is None:
+            self._write()
+
+        for static_fields, layout in self._entries:
+            data_entry = dict(static_fields)
+            for name, (offset, shape) in layout.items():
+                size = int(np.prod(shape))
+                data_entry[name] = self._arrays[name][offset : offset + size].reshape(
+                    shape
+                )
+            yield data_entry
+
+    def _write(self):
+        directory = tempfile.mkdtemp(prefix="mmap_cache_", dir=self.cache_dir)
+        weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+
+        files, dtypes, sizes, entries = {}, {}, {}, []
+        try:
+            for data_entry in self.dataset:
+                static_fields, layout = {}, {}
+                for name, value in data_entry.items():
+                    if not isinstance(value, np.ndarray) or value.dtype == object:
+                        static_fields[name] = value
+                        continue
+                    if name not in files:
+                        path = os.path.join(directory, f"field_{len(files)}.bin")
+                        files[name] = open(path, "wb")
+                        dtypes[name] = value.dtype
+                        sizes[name] = 0
+                    elif value.dtype != dtypes[name]:
+                        # one flat file per field holds a single dtype
+                        raise ValueError(
+                            f"Invalid dtype for field {name}: {value.dtype} "
+                            f"(expected {dtypes[name]})"
+                        )
+                    # taken before `ascontiguousarray`, which makes 0-d arrays 1-d
+                    shape = np.shape(value)
+                    value = np.ascontiguousarray(value)
+                    value.tofile(files[name])
+                    layout[name] = (sizes[name], shape)
+                    sizes[name] += value.size
+                entries.append((static_fields, layout))
+        finally:
+            for f in files.values():
+                f.close()
+
+        self._arrays = {
+            name: self._open(files[name].name, dtypes[name], sizes[name])
+            for name in files
+        }
+        self._entries = entries
+
+    @staticmethod
+    def _open(path: str, dtype: np.dtype, size: int) -> np.ndarray:
+        if size == 0:  # empty files cannot be memory-mapped
+            return np.empty(0, dtype=dtype)
+        array = np.memmap(path, dtype=dtype, mode="c", shape=(size,))
+        # entries are read front to back on every epoch
+        if hasattr(array, "_mmap") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            array._mmap.madvise(mmap.MADV_SEQUENTIAL)
+            array._mmap.madvise(mmap.MADV_WILLNEED)
+        return array
@@ -91,6 +91,10 @@ class TimEstimatorGrad(PyTorchLightningEstimator):
         default_scale: bool,
         default_scale_cst: bool,
         add_minimum_std: bool,
+        picard_window_size: int = 1,
+        picard_tolerance: float = 0.0,
+        inference_dtype: Optional[str] = None,
+        cuda_graph_sampling: bool = False,
         **kwargs,
     ):
 
@@ -113,6 +117,10 @@ class TimEstimatorGrad(PyTorchLightningEstimator):
         self.default_scale = default_scale
         self.default_scale_cst = default_scale_cst
         self.add_minimum_std = add_minimum_std
+        self.picard_window_size = picard_window_size
+        self.picard_tolerance = picard_tolerance
+        self.inference_dtype = inference_dtype
+        self.cuda_graph_sampling = cuda_graph_sampling
 
         super().__init__(trainer_kwargs=trainer_kwargs)
 
@@ -306,6 +314,10 @@ class TimEstimatorGrad(PyTorchLightningEstimator):
                 "default_scale": self.default_scale,
                 "default_scale_cst": self.default_scale_cst,
                 "add_minimum_std": self.add_minimum_std,
+                "picard_window_size": self.picard_window_size,
+                "picard_tolerance": self.picard_tolerance,
+                "inference_dtype": self.inference_dtype,
+                "cuda_graph_sampling": self.cuda_graph_sampling,
             },
             optim_kwargs=self.optim_kwargs,
         )
@@ -1,13 +1,14 @@
 # This code was adapted from https://github.com/zalandoresearch/pytorch-ts/blob/master/pts/model/time_grad/time_grad_network.py
 # under MIT License
 
+import contextlib
+import os
 import torch.nn as nn
-from typing import List, Optional, Union, Tuple
+from typing import Final, List, Optional, Union, Tuple
 from tsExperiments.models.project_models.timeGrad.utils import (
     GaussianDiffusion,
     DiffusionOutput,
     EpsilonTheta,
-    weighted_average,
 )
 from data_and_transformation import (
     MeanScaler,
@@ -16,10 +17,80 @@ from data_and_transformation import (
     CenteredMeanScaler,
 )
 import torch
+import torch.nn.functional as F
 from gluonts.model import Input, InputSpec
 
 
+@torch.jit.script
+def _lstm_cell(
+    x: torch.Tensor,
+    h: torch.Tensor,
+    c: torch.Tensor,
+    w_ih: torch.Tensor,
+    w_hh: torch.Tensor,
+    b_ih: torch.Tensor,
+    b_hh: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # gates in the order of `nn.LSTM`: input, forget, cell, output
+    gates = F.linear(x, w_ih, b_ih) + F.linear(h, w_hh, b_hh)
+    i, f, g, o = gates.chunk(4, 1)
+    c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+    h = torch.sigmoid(o) * torch.tanh(c)
+    return h, c
+
+
+@torch.jit.script
+def _gru_cell(
+    x: torch.Tensor,
+    h: torch.Tensor,
+    w_ih: torch.Tensor,
+    w_hh: torch.Tensor,
+    b_ih: torch.Tensor,
+    b_hh: torch.Tensor,
+) -> torch.Tensor:
+    # gates in the order of `nn.GRU`: reset, update, new
+    i_r, i_z, i_n = F.linear(x, w_ih, b_ih).chunk(3, 1)
+    h_r, h_z, h_n = F.linear(h, w_hh, b_hh).chunk(3, 1)
+    r = torch.sigmoid(i_r + h_r)
+    z = torch.sigmoid(i_z + h_z)
+    n = torch.tanh(i_n + r * h_n)
+    return n + z * (h - n)
+
+
+@torch.jit.script
+def _fused_loss(likelihoods: torch.Tensor, observed: torch.Tensor) -> torch.Tensor:
+    # `weighted_average(likelihoods, weights, dim=1).mean()`, with the time steps
+    # weighted by whether all of their target dimensions are observed
+    weights = observed.amin(dim=-1, keepdim=True)
+    weighted = torch.where(weights != 0, likelihoods * weights, 0.0)
+    return (weighted.sum(1) / weights.sum(1).clamp_min(1.0)).mean()
+
+
+@torch.jit.script
+def _mask_observed(observed: torch.Tensor, is_pad: torch.Tensor) -> torch.Tensor:
+    # padded time steps are unobserved, i.e. min(observed, 1 - is_pad) for
+    # binary indicators, without materializing `1 - is_pad`
+    return observed.masked_fill(is_pad.unsqueeze(-1).to(torch.bool), 0.0)
+
+
+@torch.jit.script
+def _affine_lags(
+    lags: torch.Tensor, inv_scale: torch.Tensor, offset: Optional[torch.Tensor]
+) -> torch.Tensor:
+    # lags * inv_scale + offset, in a single kernel
+    if offset is None:
+        return lags * inv_scale
+    return torch.addcmul(offset, lags, inv_scale)
+
+
 class PersonnalizedTimeGrad(nn.Module):
+    # constant for TorchScript, which can then drop the unused scaler branches
+    scaler_type: Final[str]
+    # widths of the scaled lags and of the dimension embeddings in the RNN
+    # inputs
+    _num_lags_times_tgt: Final[int]
+    _emb_width: Final[int]
+
     def __init__(
         self,
         num_parallel_samples: int,
@@ -49,10 +120,32 @@ class PersonnalizedTimeGrad(nn.Module):
         default_scale=True,
         default_scale_cst=True,
         add_minimum_std=True,
+        picard_window_size: int = 1,
+        picard_tolerance: float = 0.0,
+        inference_dtype: Optional[str] = None,
+        cuda_graph_sampling: bool = False,
         **kwargs,
     ):
         super().__init__(**kwargs)
 
+        if picard_window_size < 1:
+            raise ValueError(f"Invalid Picard window size: {picard_window_size}")
+        # without tolerance, windows slide by a single step: sequential decoding
+        # at the cost of the diffusion chains of whole windows
+        if picard_window_size > 1 and picard_tolerance <= 0:
+            raise ValueError(f"Invalid Picard tolerance: {picard_tolerance}")
+        self.picard_window_size = picard_window_size
+        self.picard_tolerance = picard_tolerance
+        # dtype autocast to when sampling on CUDA, None to sample in float32
+        if inference_dtype not in (None, "bfloat16", "float16"):
+            raise ValueError(f"Invalid inference dtype: {inference_dtype}")
+        self.inference_dtype: Optional[torch.dtype] = (
+            getattr(torch, inference_dtype) if inference_dtype is not None else None
+        )
+        # replay the decoding step from a CUDA graph (not yet validated on GPUs
+        # against the eager loop)
+        self.cuda_graph_sampling = cuda_graph_sampling
+
         self.scaler_type = scaler_type
         self.div_by_std = div_by_std
         self.minimum_std = minimum_std
@@ -76,6 +169,32 @@ class PersonnalizedTimeGrad(nn.Module):
 
         self.lags_seq.sort()
 
+        # time indices gathered by `get_lagged_subsequences` in the encoder,
+        # over the past only (prediction) or past and future (training)
+        self.register_buffer(
+            "_past_lag_index",
+            self.lagged_subsequences_index(
+                self.history_length, self.lags_seq, self.context_length
+            ),
+            persistent=False,
+        )
+        self.register_buffer(
+            "_past_future_lag_index",
+            self.lagged_subsequences_index(
+                self.history_length + self.prediction_length,
+                self.lags_seq,
+                self.context_length + self.prediction_length,
+            ),
+            persistent=False,
+        )
+        # when decoding, the lags of the k-th prediction step are read at
+        # `_shifted_lag_idx_base + k`
+        self.register_buffer(
+            "_shifted_lag_idx_base",
+            self.lagged_subsequences_index(self.history_length, self.shifted_lags, 1),
+            persistent=False,
+        )
+
         self.num_feat_dynamic_real = num_feat_dynamic_real
 
         self.denoise_fn = EpsilonTheta(
@@ -128,14 +247,49 @@ class PersonnalizedTimeGrad(nn.Module):
             self.scaler = NOPScaler(keepdim=True)
 
         # Calculate input_size adaptively
+        self._num_lags_times_tgt = len(self.lags_seq) * self.target_dim
+        self._emb_width = self.target_dim * self.embed_dim
         self.input_size = (
-            len(self.lags_seq) * self.target_dim
-            + self.target_dim * self.embed_dim
-            + self.num_feat_dynamic_real
+            self._num_lags_times_tgt + self._emb_width + self.num_feat_dynamic_real
         )
 
         print(f"Setting input_size to {self.input_size}")
 
+        # RNN inputs written in place when gradients are disabled, by shape
+        self._input_buffers = {}
+        # past and future data joined along time in unroll_encoder, by shape
+        self._seq_buf = {}
+
+        # the scaler type is resolved once, leaving no branch on it in `unroll`
+        # and `unroll_encoder`
+        if self.scaler_type == "mean":
+            self._compute_scale_params = self._scale_params_mean
+            self._lag_affine = self._lag_affine_mean
+        elif self.scaler_type in ("mean_std", "centered_mean"):
+            self._compute_scale_params = self._scale_params_mean_std
+            self._lag_affine = self._lag_affine_mean_std
+        else:
+            self._compute_scale_params = self._scale_params_invalid
+            self._lag_affine = self._lag_affine_invalid
+
+        # TIMEGRAD_COMPILE=1 compiles the denoiser and the projection of the
+        # RNN outputs in place (their parameter names stay the same); these
+        # then run as CUDA graphs of their own, so the decoding step is not
+        # captured as a whole
+        self.compiled = os.environ.get("TIMEGRAD_COMPILE", "0").lower() in (
+            "1",
+            "true",
+            "yes",
+        )
+        if self.compiled:
+            self.denoise_fn.compile(mode="reduce-overhead", fullgraph=True)
+            self.proj_dist_args.compile(mode="reduce-overhead", fullgraph=True)
+
+        # `proj_dist_args` holds a single linear layer, whose output the domain
+        # map of DiffusionOutput returns as is: unless compiled, it is applied
+        # with F.linear, without going through the modules' call machinery
+        self._linear_proj = not self.compiled and len(self.proj_dist_args.proj) == 1
+
         self.cell_type = cell_type
         rnn_cls = {"LSTM": nn.LSTM, "GRU": nn.GRU}[cell_type]
         self.rnn = rnn_cls(
@@ -192,12 +346,31 @@ class PersonnalizedTimeGrad(nn.Module):
             zeros_fn=torch.zeros,
         )
 
+    @staticmethod
+    def lagged_subsequences_index(
+        sequence_length: int, indices: List[int], subsequences_length: int
+    ) -> torch.Tensor:
+        """
+        Time indices of the lagged subsequences of a sequence with length
+        `sequence_length`, lag by lag, as gathered by
+        `get_lagged_subsequences`.
+        """
+        return torch.tensor(
+            [
+                sequence_length - lag_index - subsequences_length + j
+                for lag_index in indices
+                for j in range(subsequences_length)
+            ],
+            dtype=torch.long,
+        )
+
     @staticmethod
     def get_lagged_subsequences(
         sequence: torch.Tensor,
         sequence_length: int,
         indices: List[int],
         subsequences_length: int = 1,
+        lag_index: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         """
         Returns lagged subsequences of a given sequence.
@@ -212,6 +385,10 @@ class PersonnalizedTimeGrad(nn.Module):
             list of lag indices to be used.
         subsequences_length
             length of the subsequences to be extracted.
+        lag_index
+            precomputed `lagged_subsequences_index` for these arguments, on
+            the device of `sequence`; only used if `sequence` has exactly
+            `sequence_length` time steps.
         Returns
         --------
         lagged : Tensor
@@ -229,12 +406,17 @@ class PersonnalizedTimeGrad(nn.Module):
         )
         assert all(lag_index >= 0 for lag_index in indices)
 
-        lagged_values = []
-        for lag_index in indices:
-            begin_index = -lag_index - subsequences_length
-            end_index = -lag_index if lag_index > 0 else None
-            lagged_values.append(sequence[:, begin_index:end_index, ...].unsqueeze(1))
-        return torch.cat(lagged_values, dim=1).permute(0, 2, 3, 1)
+        # lags are taken from the end of the sequence
+        if lag_index is None or sequence.shape[1] != sequence_length:
+            lag_index = PersonnalizedTimeGrad.lagged_subsequences_index(
+                sequence.shape[1], indices, subsequences_length
+            ).to(sequence.device)
+
+        # (N, I * S, C) -> (N, S, C, I)
+        lagged = sequence.index_select(1, lag_index)
+        return lagged.view(
+            sequence.shape[0], len(indices), subsequences_length, -1
+        ).permute(0, 2, 3, 1)
 
     def unroll(
         self,
@@ -244,25 +426,29 @@ class PersonnalizedTimeGrad(nn.Module):
         target_dimension_indicator: torch.Tensor,
         unroll_length: int,
         begin_state: Optional[Union[List[torch.Tensor], torch.Tensor]] = None,
+        precomputed_embed: Optional[torch.Tensor] = None,
+        lag_affine: Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]] = None,
     ) -> Tuple[
         torch.Tensor,
         Union[List[torch.Tensor], torch.Tensor],
         torch.Tensor,
         torch.Tensor,
     ]:
-        if self.scaler_type == "mean":
-            scale = scale_params["scale"]
-            # (batch_size, sub_seq_len, target_dim, num_lags)
-            lags_scaled = lags / scale.unsqueeze(-1)
-            # assert_shape(
-            #     lags_scaled, (-1, unroll_length, self.target_dim, len(self.lags_seq)),
-            # )
-        elif self.scaler_type == "mean_std" or self.scaler_type == "centered_mean":
-            mean = scale_params["mean"]
-            std = scale_params["std"]
-            lags_scaled = (lags - mean.unsqueeze(-1)) / std.unsqueeze(-1)
-        else:
-            raise ValueError(f"Invalid scaler type: {self.scaler_type}")
+        """
+        Scales the lags and unrolls the RNN over them, with the embeddings of
+        the target dimensions and the time features as additional inputs.
+        `precomputed_embed` may hold these embeddings already flattened and
+        repeated over time (batch_size, unroll_length, target_dim *
+        embed_dim), as when decoding step by step, and `lag_affine` the
+        result of `self._lag_affine(scale_params)`.
+
+        With gradients disabled, the returned `inputs` are a buffer that the
+        next call with the same shape overwrites: copy them to keep them.
+        """
+        if lag_affine is None:
+            lag_affine = self._lag_affine(scale_params)
+        # (batch_size, sub_seq_len, target_dim, num_lags)
+        lags_scaled = _affine_lags(lags, *lag_affine)
 
         # (batch_size, sub_seq_len, target_dim, num_lags)
         # lags_scaled = lags / scale.unsqueeze(-1)
@@ -272,20 +458,42 @@ class PersonnalizedTimeGrad(nn.Module):
         # )
 
         input_lags = lags_scaled.reshape(
-            (-1, unroll_length, len(self.lags_seq) * self.target_dim)
+            (-1, unroll_length, self._num_lags_times_tgt)
         )
 
-        if self.embed_dim > 0:
-            # (batch_size, target_dim, embed_dim)
-            index_embeddings = self.embed(target_dimension_indicator)
-            # assert_shape(index_embeddings, (-1, self.target_dim, self.embed_dim))
-
-            # (batch_size, seq_len, target_dim * embed_dim)
-            repeated_index_embeddings = (
-                index_embeddings.unsqueeze(1)
-                .expand(-1, unroll_length, -1, -1)
-                .reshape((-1, unroll_length, self.target_dim * self.embed_dim))
+        if not torch.is_grad_enabled():
+            # no autograd graph holds on to the inputs, they can be written
+            # into a buffer reused from one call to the next
+            lags_end = self._num_lags_times_tgt
+            inputs = self._input_buffer(
+                (input_lags.shape[0], unroll_length, self.input_size), input_lags
             )
+            inputs[..., :lags_end] = input_lags
+            if self.embed_dim > 0:
+                emb_end = lags_end + self._emb_width
+                if precomputed_embed is not None:
+                    inputs[..., lags_end:emb_end] = precomputed_embed
+                else:
+                    inputs[..., lags_end:emb_end] = self.embed(
+                        target_dimension_indicator
+                    ).reshape((-1, 1, self._emb_width))
+            else:
+                emb_end = lags_end
+            inputs[..., emb_end:] = time_feat
+        elif self.embed_dim > 0:
+            if precomputed_embed is not None:
+                repeated_index_embeddings = precomputed_embed
+            else:
+                # (batch_size, target_dim, embed_dim)
+                index_embeddings = self.embed(target_dimension_indicator)
+                # assert_shape(index_embeddings, (-1, self.target_dim, self.embed_dim))
+
+                # (batch_size, seq_len, target_dim * embed_dim)
+                repeated_index_embeddings = (
+                    index_embeddings.unsqueeze(1)
+                    .expand(-1, unroll_length, -1, -1)
+                    .reshape((-1, unroll_length, self._emb_width))
+                )
 
             # (batch_size, sub_seq_len, input_dim)
             inputs = torch.cat(
@@ -295,7 +503,10 @@ class PersonnalizedTimeGrad(nn.Module):
             inputs = torch.cat((input_lags, time_feat), dim=-1)
 
         # unroll encoder
-        outputs, state = self.rnn(inputs, begin_state)
+        if unroll_length == 1 and begin_state is not None and not self.training:
+            outputs, state = self._rnn_step(inputs, begin_state)
+        else:
+            outputs, state = self.rnn(inputs, begin_state)
 
         # assert_shape(outputs, (-1, unroll_length, self.num_cells))
         # for s in state:
@@ -307,6 +518,95 @@ class PersonnalizedTimeGrad(nn.Module):
 
         return outputs, state, lags_scaled, inputs
 
+    # the parameters of the scaler, fitted on the observed past target
+    def _scale_params_mean(self, target: torch.Tensor, observed: torch.Tensor) -> dict:
+        _, scale = self.scaler(target, observed)
+        return {"scale": scale}
+
+    def _scale_params_mean_std(
+        self, target: torch.Tensor, observed: torch.Tensor
+    ) -> dict:
+        _, mean, std = self.scaler(target, observed)
+        return {"mean": mean, "std": std}
+
+    def _scale_params_invalid(self, target: torch.Tensor, observed: torch.Tensor):
+        raise ValueError(f"Invalid scaler type: {self.scaler_type}")
+
+    # the scaling of the lags as an affine map, `lags * inv_scale + offset`,
+    # with factors shaped to broadcast over the lags
+    @staticmethod
+    def _lag_affine_mean(
+        scale_params: dict,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        return scale_params["scale"].reciprocal().unsqueeze(-1), None
+
+    @staticmethod
+    def _lag_affine_mean_std(
+        scale_params: dict,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        inv_std = scale_params["std"].reciprocal().unsqueeze(-1)
+        return inv_std, -scale_params["mean"].unsqueeze(-1) * inv_std
+
+    def _lag_affine_invalid(self, scale_params: dict):
+        raise ValueError(f"Invalid scaler type: {self.scaler_type}")
+
+    def _input_buffer(self, shape: Tuple[int, ...], like: torch.Tensor) -> torch.Tensor:
+        # inference tensors cannot be written to outside of inference mode
+        key = (shape, like.dtype, like.device, torch.is_inference_mode_enabled())
+        buffer = self._input_buffers.get(key)
+        if buffer is None:
+            buffer = self._input_buffers[key] = like.new_empty(shape)
+        return buffer
+
+    def _cat_time(self, past: torch.Tensor, future: torch.Tensor) -> torch.Tensor:
+        # data never requires grad, so the result is consumed within the step
+        # and its buffer can be refilled by the next one; buffers made under
+        # inference mode can only be written to there, hence their own key
+        if past.requires_grad or future.requires_grad:
+            return torch.cat((past, future), dim=1)
+        shape = (past.shape[0], past.shape[1] + future.shape[1]) + past.shape[2:]
+        key = (shape, past.dtype, past.device, torch.is_inference_mode_enabled())
+        buffer = self._seq_buf.get(key)
+        if buffer is None:
+            buffer = self._seq_buf[key] = past.new_empty(shape)
+        return torch.cat((past, future), dim=1, out=buffer)
+
+    def clear_buffers(self) -> None:
+        """
+        Frees the buffers kept for the inputs of the encoder, e.g. once the
+        batch shape is not going to be seen again.
+        """
+        self._input_buffers.clear()
+        self._seq_buf.clear()
+
+    def _rnn_step(
+        self,
+        inputs: torch.Tensor,
+        begin_state: Union[List[torch.Tensor], torch.Tensor],
+    ) -> Tuple[torch.Tensor, Union[Tuple[torch.Tensor, torch.Tensor], torch.Tensor]]:
+        """
+        Runs `self.rnn` over a single time step with scripted cells, layer by
+        layer, which avoids the overhead of a full cuDNN RNN call when
+        decoding. Inter-layer dropout is not applied: this is for inference.
+        """
+        x = inputs[:, 0]
+        hs = []
+        # `all_weights` lists (w_ih, w_hh, b_ih, b_hh) per layer, following the
+        # parameters of `self.rnn` wherever they are moved
+        if self.cell_type == "LSTM":
+            h0, c0 = begin_state
+            cs = []
+            for layer, weights in enumerate(self.rnn.all_weights):
+                x, c = _lstm_cell(x, h0[layer], c0[layer], *weights)
+                hs.append(x)
+                cs.append(c)
+            return x.unsqueeze(1), (torch.stack(hs), torch.stack(cs))
+
+        for layer, weights in enumerate(self.rnn.all_weights):
+            x = _gru_cell(x, begin_state[layer], *weights)
+            hs.append(x)
+        return x.unsqueeze(1), torch.stack(hs)
+
     def unroll_encoder(
         self,
         past_time_feat: torch.Tensor,
@@ -322,13 +622,14 @@ class PersonnalizedTimeGrad(nn.Module):
         torch.Tensor,
         torch.Tensor,
         torch.Tensor,
+        torch.Tensor,
     ]:
         """
         Unrolls the RNN encoder over past and, if present, future data.
         Returns outputs and state of the encoder, plus the scale of
-        past_target_cdf and a vector of static features that was constructed
-        and fed as input to the encoder. All tensor arguments should have NTC
-        layout.
+        past_target_cdf, a vector of static features that was constructed
+        and fed as input to the encoder and the target sequence the lags were
+        taken from. All tensor arguments should have NTC layout.
 
         Parameters
         ----------
@@ -363,27 +664,31 @@ class PersonnalizedTimeGrad(nn.Module):
         lags_scaled
             Scaled lags(batch_size, sub_seq_len, target_dim, num_lags)
         inputs
-            inputs to the RNN
+            inputs to the RNN, overwritten by the next call with the same
+            shape when gradients are disabled (see `unroll`)
+        sequence
+            Past target, followed by the future one if given (batch_size,
+            history_length [+ prediction_length], target_dim); it may live in
+            a buffer reused by the next call, so it is not to be modified
 
         """
 
-        past_observed_values = torch.min(
-            past_observed_values, 1 - past_is_pad.unsqueeze(-1)
-        )
+        past_observed_values = _mask_observed(past_observed_values, past_is_pad)
 
         if future_time_feat is None or future_target_cdf is None:
             time_feat = past_time_feat[:, -self.context_length :, ...]
             sequence = past_target_cdf
             sequence_length = self.history_length
             subsequences_length = self.context_length
+            lag_index = self._past_lag_index
         else:
-            time_feat = torch.cat(
-                (past_time_feat[:, -self.context_length :, ...], future_time_feat),
-                dim=1,
+            time_feat = self._cat_time(
+                past_time_feat[:, -self.context_length :, ...], future_time_feat
             )
-            sequence = torch.cat((past_target_cdf, future_target_cdf), dim=1)
+            sequence = self._cat_time(past_target_cdf, future_target_cdf)
             sequence_length = self.history_length + self.prediction_length
             subsequences_length = self.context_length + self.prediction_length
+            lag_index = self._past_future_lag_index
 
         # (batch_size, sub_seq_len, target_dim, num_lags)
         lags = self.get_lagged_subsequences(
@@ -391,24 +696,15 @@ class PersonnalizedTimeGrad(nn.Module):
             sequence_length=sequence_length,
             indices=self.lags_seq,
             subsequences_length=subsequences_length,
+            lag_index=lag_index,
         )
 
         # scale is computed on the context length last units of the past target
         # scale shape is (batch_size, 1, target_dim)
-        if self.scaler_type == "mean":
-            _, scale = self.scaler(
-                past_target_cdf[:, -self.context_length :, ...],
-                past_observed_values[:, -self.context_length :, ...],
-            )
-            scale_params = {"scale": scale}
-        elif self.scaler_type == "mean_std" or self.scaler_type == "centered_mean":
-            _, mean, std = self.scaler(
-                past_target_cdf[:, -self.context_length :, ...],
-                past_observed_values[:, -self.context_length :, ...],
-            )
-            scale_params = {"mean": mean, "std": std}
-        else:
-            raise ValueError(f"Invalid scaler type: {self.scaler_type}")
+        scale_params = self._compute_scale_params(
+            past_target_cdf[:, -self.context_length :, ...],
+            past_observed_values[:, -self.context_length :, ...],
+        )
 
         # scale is computed on the context length last units of the past target
         # scale shape is (batch_size, 1, target_dim)
@@ -426,7 +722,7 @@ class PersonnalizedTimeGrad(nn.Module):
             scale_params=scale_params,
         )
 
-        return outputs, states, scale_params, lags_scaled, inputs
+        return outputs, states, scale_params, lags_scaled, inputs, sequence
 
     def distr_args(self, rnn_outputs: torch.Tensor):
         """
@@ -446,6 +742,10 @@ class PersonnalizedTimeGrad(nn.Module):
         distr_args
             Distribution arguments
         """
+        if self._linear_proj:
+            proj = self.proj_dist_args.proj[0]
+            return F.linear(rnn_outputs, proj.weight, proj.bias)
+
         (distr_args,) = self.proj_dist_args(rnn_outputs)
 
         return distr_args
@@ -506,7 +806,7 @@ class PersonnalizedTimeGrad(nn.Module):
 
         # unroll the decoder in "training mode", i.e. by providing future data
         # as well
-        rnn_outputs, _, scale_params, _, _ = self.unroll_encoder(
+        rnn_outputs, _, scale_params, _, _, sequence = self.unroll_encoder(
             past_time_feat=past_time_feat,
             past_target_cdf=past_target_cdf,
             past_observed_values=past_observed_values,
@@ -516,12 +816,9 @@ class PersonnalizedTimeGrad(nn.Module):
             target_dimension_indicator=target_dimension_indicator,
         )
 
-        # put together target sequence
+        # target sequence, a view of the one the encoder put together
         # (batch_size, seq_len, target_dim)
-        target = torch.cat(
-            (past_target_cdf[:, -self.context_length :, ...], future_target_cdf),
-            dim=1,
-        )
+        target = sequence[:, -seq_len:]
 
         # assert_shape(target, (-1, seq_len, self.target_dim))
 
@@ -537,9 +834,7 @@ class PersonnalizedTimeGrad(nn.Module):
 
         # assert_shape(likelihoods, (-1, seq_len, 1))
 
-        past_observed_values = torch.min(
-            past_observed_values, 1 - past_is_pad.unsqueeze(-1)
-        )
+        past_observed_values = _mask_observed(past_observed_values, past_is_pad)
 
         # (batch_size, subseq_length, target_dim)
         observed_values = torch.cat(
@@ -551,18 +846,12 @@ class PersonnalizedTimeGrad(nn.Module):
         )
 
         # mask the loss at one time step if one or more observations is missing
-        # in the target dimensions (batch_size, subseq_length, 1)
-        loss_weights, _ = observed_values.min(dim=-1, keepdim=True)
-
-        # assert_shape(loss_weights, (-1, seq_len, 1))
-
-        loss = weighted_average(likelihoods, weights=loss_weights, dim=1)
-
-        # assert_shape(loss, (-1, -1, 1))
+        # in the target dimensions, average it over time and then over the batch
+        loss = _fused_loss(likelihoods, observed_values)
 
         # self.distribution = distr
 
-        return (loss.mean(), likelihoods, distr_args)
+        return (loss, likelihoods, distr_args)
 
     def sampling_decoder(
         self,
@@ -606,9 +895,24 @@ class PersonnalizedTimeGrad(nn.Module):
                 for key, value in dict.items()
             }
 
+        batch_size = past_target_cdf.shape[0]
+
         # blows-up the dimension of each tensor to
-        # batch_size * self.num_sample_paths for increasing parallelism
-        repeated_past_target_cdf = repeat(past_target_cdf)
+        # batch_size * self.num_sample_paths for increasing parallelism;
+        # `sequence` holds the past values followed by the samples, filled
+        # step by step, the past values being broadcast over the samples
+        sequence = past_target_cdf.new_empty(
+            (
+                batch_size * self.num_parallel_samples,
+                self.history_length + self.prediction_length,
+                self.target_dim,
+            )
+        )
+        sequence.view(batch_size, self.num_parallel_samples, -1, self.target_dim)[
+            :, :, : self.history_length
+        ] = past_target_cdf.unsqueeze(1)
+        # each step feeds a contiguous (batch_size * num_samples, 1, features)
+        # slice to the RNN, copying these per step would not save anything
         repeated_time_feat = repeat(time_feat)
         # repeated_scale = repeat(scale)
         if type(scale_params) == dict:
@@ -617,23 +921,126 @@ class PersonnalizedTimeGrad(nn.Module):
             repeated_scale = scale_params
         if self.scaling:
             self.diffusion.scale = repeated_scale
-        repeated_target_dimension_indicator = repeat(target_dimension_indicator)
+        # the embeddings do not change from one step to the next, they are
+        # looked up once per series and broadcast over the samples
+        # (batch_size * num_samples, 1, target_dim * embed_dim)
+        index_embeddings = (
+            self.embed(target_dimension_indicator)
+            .reshape((batch_size, 1, 1, self._emb_width))
+            .expand(-1, self.num_parallel_samples, -1, -1)
+            .reshape((-1, 1, self._emb_width))
+            if self.embed_dim > 0
+            else None
+        )
 
         if self.cell_type == "LSTM":
-            repeated_states = [repeat(s, dim=1) for s in begin_states]
+            repeated_states = (
+                repeat(begin_states[0], dim=1),
+                repeat(begin_states[1], dim=1),
+            )
         else:
             repeated_states = repeat(begin_states, dim=1)
 
-        future_samples = []
+        with self._sampling_autocast(sequence):
+            # (batch_size * num_samples, prediction_length, target_dim)
+            samples = self._decode(
+                sequence,
+                repeated_time_feat,
+                repeated_scale,
+                target_dimension_indicator,
+                repeated_states,
+                index_embeddings,
+            )
+
+        # (batch_size, num_samples, prediction_length, target_dim)
+        return samples.reshape(
+            (
+                -1,
+                self.num_parallel_samples,
+                self.prediction_length,
+                self.target_dim,
+            )
+        )
+
+    @contextlib.contextmanager
+    def _sampling_autocast(self, sequence: torch.Tensor):
+        """
+        Autocasting to `inference_dtype` when sampling on CUDA: the RNN and
+        the denoiser run in reduced precision, while the diffusion chain and
+        the scaling of the samples stay in float32, with matmuls allowed to
+        use TF32 tensor cores.
+        """
+        dtype = self.inference_dtype
+        if (
+            not sequence.is_cuda
+            or dtype is None
+            or (dtype == torch.bfloat16 and not torch.cuda.is_bf16_supported())
+        ):
+            yield
+            return
+        allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        try:
+            with torch.autocast(device_type="cuda", dtype=dtype):
+                yield
+        finally:
+            torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+
+    def _decode(
+        self,
+        sequence: torch.Tensor,
+        repeated_time_feat: torch.Tensor,
+        repeated_scale: dict,
+        target_dimension_indicator: torch.Tensor,
+        repeated_states: Union[List[torch.Tensor], torch.Tensor],
+        index_embeddings: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Samples the prediction steps one after the other, or by Picard
+        iterations, or from a CUDA graph, writing the samples into `sequence`
+        after the past values and returning them. Only `index_embeddings`
+        are repeated for the samples, `target_dimension_indicator` is not:
+        it is only used to compute them.
+        """
+        if self.picard_window_size > 1:
+            return self._sample_with_picard(
+                sequence,
+                repeated_time_feat,
+                repeated_scale,
+                target_dimension_indicator,
+                repeated_states,
+                index_embeddings,
+            )
+
+        if (
+            self.cuda_graph_sampling
+            and sequence.is_cuda
+            and not self.training
+            and not self.compiled
+        ):
+            samples = self._sample_with_cuda_graph(
+                sequence,
+                repeated_time_feat,
+                repeated_scale,
+                target_dimension_indicator,
+                repeated_states,
+                index_embeddings,
+            )
+            if samples is not None:
+                return samples
+
+        # the scaling of the lags is the same at every step
+        lag_affine = self._lag_affine(repeated_scale)
 
         # for each future time-units we draw new samples for this time-unit
         # and update the state
         for k in range(self.prediction_length):
             lags = self.get_lagged_subsequences(
-                sequence=repeated_past_target_cdf,
+                sequence=sequence[:, : self.history_length + k],
                 sequence_length=self.history_length + k,
                 indices=self.shifted_lags,
                 subsequences_length=1,
+                lag_index=self._shifted_lag_idx_base + k,
             )
 
             rnn_outputs, repeated_states, _, _ = self.unroll(
@@ -642,8 +1049,10 @@ class PersonnalizedTimeGrad(nn.Module):
                 # scale=repeated_scale,
                 scale_params=repeated_scale,
                 time_feat=repeated_time_feat[:, k : k + 1, ...],
-                target_dimension_indicator=repeated_target_dimension_indicator,
+                target_dimension_indicator=target_dimension_indicator,
                 unroll_length=1,
+                precomputed_embed=index_embeddings,
+                lag_affine=lag_affine,
             )
 
             distr_args = self.distr_args(rnn_outputs=rnn_outputs)
@@ -651,24 +1060,229 @@ class PersonnalizedTimeGrad(nn.Module):
             # (batch_size, 1, target_dim)
             new_samples = self.diffusion.sample(cond=distr_args)
 
-            # (batch_size, seq_len, target_dim)
-            future_samples.append(new_samples)
-            repeated_past_target_cdf = torch.cat(
-                (repeated_past_target_cdf, new_samples), dim=1
+            sequence[:, self.history_length + k] = new_samples.squeeze(1)
+
+        return sequence[:, self.history_length :]
+
+    def _sample_with_picard(
+        self,
+        sequence: torch.Tensor,
+        time_feat: torch.Tensor,
+        scale_params: dict,
+        target_dimension_indicator: torch.Tensor,
+        begin_states: Union[List[torch.Tensor], torch.Tensor],
+        index_embeddings: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Decodes by Picard iterations over windows of `picard_window_size`
+        prediction steps, in the manner of ParaDiGMS: the RNN is unrolled over
+        the values guessed for the window, and the diffusion chains of all its
+        steps are run as one batch. The leading steps of the window are
+        accepted as soon as the values of the steps before them agree, up to
+        `picard_tolerance`, with those they were computed from, and the
+        window slides past them. The first step of the window is always
+        accepted, so this takes at most `prediction_length` iterations.
+
+        The noise of each step is drawn once for all iterations, so that the
+        samples match those of sequential decoding under the same noise up to
+        the tolerance, an absolute difference in the units of the target
+        (e.g. 1e-2 for targets of unit scale).
+
+        Returns
+        -------
+        samples
+            Sampled values (batch_size * num_samples, prediction_length,
+            target_dim), also written into `sequence`.
+        """
+        n = sequence.shape[0]
+        window_size = self.picard_window_size
+        num_timesteps = self.diffusion.num_timesteps
+        start = self.history_length
+
+        # noise of the diffusion chain of each step of the window
+        noise = torch.randn(
+            (num_timesteps + 1, n, window_size, self.target_dim),
+            device=sequence.device,
+        )
+        # initial guess: the last observed value
+        sequence[:, start:] = sequence[:, start - 1 : start]
+        states = begin_states
+        lag_affine = self._lag_affine(scale_params)
+
+        def unroll_window(k: int, length: int):
+            lags = self.get_lagged_subsequences(
+                sequence=sequence[:, : start + k + length - 1],
+                sequence_length=start + k + length - 1,
+                indices=self.shifted_lags,
+                subsequences_length=length,
+                lag_index=(
+                    self._shifted_lag_idx_base.unsqueeze(1)
+                    + torch.arange(k, k + length, device=sequence.device)
+                ).flatten(),
+            )
+            return self.unroll(
+                begin_state=states,
+                lags=lags,
+                scale_params=scale_params,
+                time_feat=time_feat[:, k : k + length],
+                target_dimension_indicator=target_dimension_indicator,
+                unroll_length=length,
+                precomputed_embed=(
+                    None
+                    if index_embeddings is None
+                    else index_embeddings.expand(-1, length, -1)
+                ),
+                lag_affine=lag_affine,
             )
 
-        # (batch_size * num_samples, prediction_length, target_dim)
-        samples = torch.cat(future_samples, dim=1)
+        k = 0
+        while k < self.prediction_length:
+            length = min(window_size, self.prediction_length - k)
+            rnn_outputs, window_states, _, _ = unroll_window(k, length)
+
+            # (n * length, 1, cond_length)
+            cond = self.distr_args(rnn_outputs).reshape(n * length, 1, -1)
+            new_samples = self.diffusion.p_sample_loop(
+                (n * length, 1, self.target_dim),
+                cond,
+                noise=noise[:, :, :length].reshape(
+                    num_timesteps + 1, n * length, 1, self.target_dim
+                ),
+            )
+            new_samples = self.diffusion.rescale(
+                new_samples.view(n, length, self.target_dim)
+            )
 
-        # (batch_size, num_samples, prediction_length, target_dim)
-        return samples.reshape(
-            (
-                -1,
-                self.num_parallel_samples,
-                self.prediction_length,
-                self.target_dim,
+            window = sequence[:, start + k : start + k + length]
+            # (length,)
+            error = (new_samples - window).abs().amax(dim=(0, 2))
+            window.copy_(new_samples)
+
+            # a step is final once all the steps before it have converged
+            stride = min(
+                int((error <= self.picard_tolerance).cumprod(0).sum().item()) + 1,
+                length,
+            )
+            if stride == length:
+                states = window_states
+            else:
+                _, states, _, _ = unroll_window(k, stride)
+
+            k += stride
+            noise = torch.cat(
+                (
+                    noise[:, :, stride:],
+                    torch.randn(
+                        (num_timesteps + 1, n, stride, self.target_dim),
+                        device=sequence.device,
+                    ),
+                ),
+                dim=2,
             )
+
+        return sequence[:, start:]
+
+    def _sample_with_cuda_graph(
+        self,
+        sequence: torch.Tensor,
+        time_feat: torch.Tensor,
+        scale_params: dict,
+        target_dimension_indicator: torch.Tensor,
+        begin_states: Union[List[torch.Tensor], torch.Tensor],
+        index_embeddings: Optional[torch.Tensor] = None,
+    ) -> Optional[torch.Tensor]:
+        """
+        Same as the decoding loop of `sampling_decoder`, with the decoding
+        step captured once in a CUDA graph and replayed for every time
+        step, which removes the kernel launch overhead of the RNN and
+        of the diffusion steps. All inputs are already repeated for the
+        parallel samples, and `sequence` holds the past values followed by
+        room for the samples, which are written into it.
+
+        Returns
+        -------
+        samples
+            Sampled values (batch_size * num_samples, prediction_length,
+            target_dim), or None if the step could not be captured.
+        """
+        device = sequence.device
+
+        # the graph reads and writes static copies only: the past and sampled
+        # values, the RNN states and the index of the current step. The inputs
+        # are left untouched until the whole loop has been replayed
+        static_sequence = sequence.clone()
+        initial_states = (
+            list(begin_states) if self.cell_type == "LSTM" else [begin_states]
         )
+        states = [s.clone() for s in initial_states]
+        step = torch.zeros(1, dtype=torch.long, device=device)
+        lag_affine = self._lag_affine(scale_params)
+
+        def decoding_step():
+            lags = (
+                static_sequence.index_select(1, self._shifted_lag_idx_base + step)
+                .unsqueeze(2)
+                .permute(0, 2, 3, 1)
+            )
+            rnn_outputs, new_states, _, _ = self.unroll(
+                begin_state=states if self.cell_type == "LSTM" else states[0],
+                lags=lags,
+                scale_params=scale_params,
+                time_feat=time_feat.index_select(1, step),
+                target_dimension_indicator=target_dimension_indicator,
+                unroll_length=1,
+                precomputed_embed=index_embeddings,
+                lag_affine=lag_affine,
+            )
+            if self.cell_type != "LSTM":
+                new_states = [new_states]
+            for state, new_state in zip(states, new_states):
+                state.copy_(new_state)
+
+            new_samples = self.diffusion.sample(cond=self.distr_args(rnn_outputs))
+            static_sequence.index_copy_(1, step + self.history_length, new_samples)
+            step.add_(1)
+
+        def reset():
+            static_sequence.copy_(sequence)
+            for state, initial_state in zip(states, initial_states):
+                state.copy_(initial_state)
+            step.zero_()
+
+        try:
+            # the autocast cache must not hold weights cast during capture
+            with torch.no_grad(), torch.autocast(
+                device_type="cuda",
+                dtype=torch.get_autocast_gpu_dtype(),
+                enabled=torch.is_autocast_enabled(),
+                cache_enabled=False,
+            ):
+                # the scripted functions are specialized by the profiling
+                # executor over their first runs, which must not be the one
+                # captured: warm up on a side stream, as required before
+                # capturing, then start again from the initial values
+                side_stream = torch.cuda.Stream(device=device)
+                side_stream.wait_stream(torch.cuda.current_stream(device))
+                with torch.cuda.stream(side_stream):
+                    for _ in range(3):
+                        reset()
+                        decoding_step()
+                torch.cuda.current_stream(device).wait_stream(side_stream)
+
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph):
+                    decoding_step()
+                reset()
+                for _ in range(self.prediction_length):
+                    graph.replay()
+        except RuntimeError:
+            # e.g. kernels that do not support stream capture: nothing has
+            # been written to the inputs, the caller falls back to the eager
+            # loop
+            return None
+
+        sequence.copy_(static_sequence)
+        return sequence[:, self.history_length :]
 
     def forward(
         self,
@@ -713,12 +1327,10 @@ class PersonnalizedTimeGrad(nn.Module):
 
         # mark padded data as unobserved
         # (batch_size, target_dim, seq_len)
-        past_observed_values = torch.min(
-            past_observed_values, 1 - past_is_pad.unsqueeze(-1)
-        )
+        past_observed_values = _mask_observed(past_observed_values, past_is_pad)
 
         # unroll the decoder in "prediction mode", i.e. with past data only
-        _, begin_states, scale_params, _, _ = self.unroll_encoder(
+        _, begin_states, scale_params, _, _, _ = self.unroll_encoder(
             past_time_feat=past_time_feat,
             past_target_cdf=past_target_cdf,
             past_observed_values=past_observed_values,
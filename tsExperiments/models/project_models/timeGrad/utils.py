@@ -123,6 +123,18 @@ class CondUpsampler(nn.Module):
 
 
 class EpsilonTheta(nn.Module):
+    """
+    Denoising network of TimeGrad. It is built from `Conv1d` layers over
+    (batch, channels, target_dim) inputs, whose "length" axis is the target
+    dimension, and is conditioned on the RNN outputs.
+
+    Channels-last memory formats do not apply: they are only defined for 4D
+    (`channels_last`) and 5D (`channels_last_3d`) tensors, and converting the
+    module with `.to(memory_format=...)` leaves 3D convolution weights as they
+    are. Inputs are kept contiguous in the default layout, which is the one
+    cuDNN expects for 1D convolutions.
+    """
+
     def __init__(
         self,
         target_dim,
@@ -347,26 +359,37 @@ class GaussianDiffusion(nn.Module):
         return model_mean, posterior_variance, posterior_log_variance
 
     @torch.no_grad()
-    def p_sample(self, x, cond, t, clip_denoised=False, repeat_noise=False):
+    def p_sample(
+        self, x, cond, t, clip_denoised=False, repeat_noise=False, noise=None
+    ):
         b, *_, device = *x.shape, x.device
         model_mean, _, model_log_variance = self.p_mean_variance(
             x=x, cond=cond, t=t, clip_denoised=clip_denoised
         )
-        noise = noise_like(x.shape, device, repeat_noise)
+        if noise is None:
+            noise = noise_like(x.shape, device, repeat_noise)
         # no noise when t == 0
         nonzero_mask = (1 - (t == 0).float()).reshape(b, *((1,) * (len(x.shape) - 1)))
         return model_mean + nonzero_mask * (0.5 * model_log_variance).exp() * noise
 
     @torch.no_grad()
-    def p_sample_loop(self, shape, cond):
+    def p_sample_loop(self, shape, cond, noise=None):
+        """
+        `noise`, of shape (num_timesteps + 1, *shape), optionally gives the
+        starting point of the chain followed by the noise of each step, in
+        sampling order, instead of drawing them.
+        """
         device = self.betas.device
 
         b = shape[0]
-        img = torch.randn(shape, device=device)
+        img = torch.randn(shape, device=device) if noise is None else noise[0]
 
         for i in reversed(range(0, self.num_timesteps)):
             img = self.p_sample(
-                img, cond, torch.full((b,), i, device=device, dtype=torch.long)
+                img,
+                cond,
+                torch.full((b,), i, device=device, dtype=torch.long),
+                noise=None if noise is None else noise[self.num_timesteps - i],
             )
         return img
 
@@ -377,7 +400,10 @@ class GaussianDiffusion(nn.Module):
         else:
             shape = sample_shape
         x_hat = self.p_sample_loop(shape, cond)
+        return self.rescale(x_hat)
 
+    def rescale(self, x_hat):
+        """Maps samples back to the scale of the data, given `self.scale`."""
         if self.scale is not None:
             if len(self.scale) == 1:
                 x_hat *= self.scale["scale"]  # the scale
@@ -439,7 +465,7 @@ class GaussianDiffusion(nn.Module):
                 pass
 
             elif len(self.scale) == 1:
-                x /= self.scale["scale"]  # we scale as in timegrad.
+                x = x / self.scale["scale"]  # we scale as in timegrad.
             elif len(self.scale) == 2:
                 mean = self.scale["mean"]
                 std = self.scale["std"]